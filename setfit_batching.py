@@ -0,0 +1,75 @@
+import random
+
+MAX_PAIRS_PER_DIVISION = 200
+BATCHES_PER_CHUNK = 50
+
+def sample_pairs(labels, max_pairs_per_division=MAX_PAIRS_PER_DIVISION, seed=42):
+    '''
+        Sampling contrastive pairs as (index_a, index_b, similarity).
+        Every division with at least two texts gets up to max_pairs_per_division // 2 unique positive pairs
+        (same division), capped by the number of possible pairs, and exactly as many negative pairs
+        (other division). Positive pairs are never repeated, so a small division does not get more weight
+        than its texts allow, and positives and negatives stay balanced over the whole set.
+    '''
+    rng = random.Random(seed)
+    indices_by_division = {}
+    for index, label in enumerate(labels):
+        indices_by_division.setdefault(label, []).append(index)
+
+    pairs = []
+    all_indices = list(range(len(labels)))
+    for division, indices in indices_by_division.items():
+        if len(indices) < 2 or len(indices) == len(labels):
+            continue
+
+        possible_positive = len(indices) * (len(indices) - 1) // 2
+        num_positive = min(max_pairs_per_division // 2, possible_positive)
+        positive = set()
+        while len(positive) < num_positive:
+            positive.add(tuple(sorted(rng.sample(indices, 2))))
+        pairs.extend((index_a, index_b, 1.0) for index_a, index_b in sorted(positive))
+
+        for _ in range(num_positive):
+            index_a = rng.choice(indices)
+            index_b = rng.choice(all_indices)
+            while labels[index_b] == division:
+                index_b = rng.choice(all_indices)
+            pairs.append((index_a, index_b, 0.0))
+
+    print(f"Sampled {len(pairs)} pairs for {len(indices_by_division)} divisions (max {max_pairs_per_division} per division)")
+
+    return pairs
+
+def order_pairs(pairs, lengths):
+    '''
+        Ordering every pair so the shorter text is on side A.
+        The cosine similarity is symmetric, so swapping the sides does not change the training signal.
+    '''
+    return [(index_b, index_a, label) if lengths[index_a] > lengths[index_b] else (index_a, index_b, label)
+            for index_a, index_b, label in pairs]
+
+def length_sorted_batches(sort_keys, batch_size, batches_per_chunk=BATCHES_PER_CHUNK, seed=42):
+    '''
+        Splitting item indices into batches of similar length to reduce padding.
+        The items are shuffled, cut into chunks of batches_per_chunk full batches, sorted by their key inside
+        every chunk and split into batches of batch_size. Only the last batch can be smaller than batch_size.
+        The order of the batches is shuffled as well.
+    '''
+    rng = random.Random(seed)
+    indices = list(range(len(sort_keys)))
+    rng.shuffle(indices)
+
+    chunk_size = batch_size * batches_per_chunk
+    batches = []
+    for start in range(0, len(indices), chunk_size):
+        chunk = sorted(indices[start:start + chunk_size], key=lambda index: sort_keys[index])
+        batches.extend(chunk[i:i + batch_size] for i in range(0, len(chunk), batch_size))
+    rng.shuffle(batches)
+
+    return batches
+
+def pair_sort_keys(pairs, lengths):
+    '''
+        Building the sort key of every (ordered) pair: the longer side first, then the shorter side.
+    '''
+    return [(lengths[index_b], lengths[index_a]) for index_a, index_b, _ in pairs]
@@ -0,0 +1,341 @@
+import copy
+import hashlib
+import json
+import os
+import shutil
+import time
+import numpy as np
+import torch
+from transformers import get_linear_schedule_with_warmup
+from transformers.trainer_callback import TrainerState
+from setfit_batching import BATCHES_PER_CHUNK, MAX_PAIRS_PER_DIVISION, length_sorted_batches, order_pairs, pair_sort_keys, sample_pairs
+
+CACHE_DIR = "tokenized_cache"
+CHECKPOINT_DIR = "checkpoints"
+WARMUP_PROPORTION = 0.1
+TOKEN_DTYPE = np.dtype(np.int32)
+
+def deduplicate_descriptions(df, text_column="tender_description", label_column="division"):
+    '''
+        Removing empty, non-string and duplicated descriptions so every unique text only appears once.
+        The descriptions are stripped like SentenceTransformer.tokenize does. The first label found for a description is kept.
+    '''
+    deduplicated_df = df.dropna(subset=[text_column, label_column])
+    is_text = deduplicated_df[text_column].apply(lambda text: isinstance(text, str) and text.strip() != "")
+    deduplicated_df = deduplicated_df[is_text]
+    deduplicated_df = deduplicated_df.assign(**{text_column: deduplicated_df[text_column].str.strip()})
+    deduplicated_df = deduplicated_df.drop_duplicates(subset=[text_column], keep="first").reset_index(drop=True)
+
+    print(f"Deduplicated descriptions: {df.shape[0]} rows -> {deduplicated_df.shape[0]} unique texts")
+
+    return deduplicated_df
+
+def get_label_ids(model, divisions):
+    '''
+        Mapping the division numbers to the label ids of the model, so model.predict returns the right division.
+        Returns the division numbers unchanged if the model was created without labels.
+    '''
+    divisions = [int(division) for division in divisions]
+    if not model.labels:
+        return divisions
+    return [model.label2id[f"{division:02d}"] for division in divisions]
+
+def get_label_id_or_none(model, division):
+    '''
+        Mapping one division number to the label id of the model. Returns None for a missing or unknown division.
+    '''
+    try:
+        division = int(division)
+    except (TypeError, ValueError):
+        return None
+    if not model.labels:
+        return division
+    return model.label2id.get(f"{division:02d}")
+
+def filter_known_divisions(model, df, label_column="division"):
+    '''
+        Dropping the rows whose division is not one of the labels of the model.
+    '''
+    if not model.labels:
+        return df
+    is_known = df[label_column].apply(lambda division: f"{int(division):02d}" in model.label2id)
+    if not is_known.all():
+        print(f"Dropping {(~is_known).sum()} rows with a division that is not a model label")
+    return df[is_known].reset_index(drop=True)
+
+def get_cache_paths(cache_dir, model_name, max_length):
+    '''
+        Building the cache file paths. Every tokenizer / max_length combination gets its own files:
+        the token ids of all texts appended to one binary file and a json index of (offset, length) per text.
+    '''
+    cache_key = hashlib.sha1(f"{model_name}_{max_length}".encode("utf-8")).hexdigest()[:16]
+    tokens_path = os.path.join(cache_dir, f"tokens_{cache_key}.bin")
+    index_path = os.path.join(cache_dir, f"tokens_{cache_key}_index.json")
+    return tokens_path, index_path
+
+def load_cache_index(tokens_path, index_path):
+    '''
+        Reading the cache index. A missing, unreadable or inconsistent cache is treated as empty.
+    '''
+    if not os.path.isfile(index_path) or not os.path.isfile(tokens_path):
+        return {}
+    try:
+        with open(index_path, 'r') as file:
+            index = json.load(file)
+    except (OSError, ValueError) as e:
+        print(f"Tokenizer cache index {index_path} is unreadable, starting with an empty cache: {e}")
+        return {}
+
+    end = max((start + length for start, length in index.values()), default=0)
+    if os.path.getsize(tokens_path) < end * TOKEN_DTYPE.itemsize:
+        print(f"Tokenizer cache {tokens_path} is shorter than its index, starting with an empty cache")
+        return {}
+    return index
+
+def write_json_atomic(path, data):
+    '''
+        Writing a json file through a temporary file, so an interrupted write never leaves a truncated file.
+    '''
+    temp_path = f"{path}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(data, file)
+    os.replace(temp_path, path)
+
+def tokenize_descriptions(texts, tokenizer, model_name, max_length, cache_dir=CACHE_DIR):
+    '''
+        Tokenizing every unique text once. Already tokenized texts are read from the cache on disk,
+        only new texts are tokenized and appended to the cache.
+        The texts are stripped before hashing and tokenizing, like SentenceTransformer.tokenize does.
+        Returns a list of token id lists in the same order as the given texts.
+    '''
+    texts = [str(text).strip() for text in texts]
+    os.makedirs(cache_dir, exist_ok=True)
+    tokens_path, index_path = get_cache_paths(cache_dir, model_name, max_length)
+    index = load_cache_index(tokens_path, index_path)
+
+    keys = [hashlib.sha1(text.encode("utf-8")).hexdigest() for text in texts]
+    missing = {key: text for key, text in zip(keys, texts) if key not in index}
+
+    print(f"Tokenizer cache: {len(texts) - len(missing)} cached, {len(missing)} new texts")
+
+    if missing:
+        start_time = time.time()
+        encoded = tokenizer(list(missing.values()), truncation=True, max_length=max_length)
+        end = max((start + length for start, length in index.values()), default=0)
+        with open(tokens_path, 'ab') as file:
+            # drop token ids of an interrupted earlier run that never made it into the index
+            file.truncate(end * TOKEN_DTYPE.itemsize)
+            for key, input_ids in zip(missing.keys(), encoded["input_ids"]):
+                file.write(np.asarray(input_ids, dtype=TOKEN_DTYPE).tobytes())
+                index[key] = [end, len(input_ids)]
+                end += len(input_ids)
+        write_json_atomic(index_path, index)
+        print(f"Tokenized {len(missing)} texts in {time.time() - start_time:.2f} seconds. Saved cache to {tokens_path}")
+
+    if not keys:
+        return []
+    token_ids = np.memmap(tokens_path, dtype=TOKEN_DTYPE, mode='r')
+    return [token_ids[index[key][0]:index[key][0] + index[key][1]].tolist() for key in keys]
+
+def collate(token_ids, pad_token_id, device):
+    '''
+        Padding a batch of token id lists to the longest item of the batch.
+    '''
+    max_length = max(len(ids) for ids in token_ids)
+    input_ids = torch.full((len(token_ids), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(token_ids), max_length), dtype=torch.long)
+    for row, ids in enumerate(token_ids):
+        input_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[row, :len(ids)] = 1
+    return {"input_ids": input_ids.to(device), "attention_mask": attention_mask.to(device)}
+
+def embed_side(model_body, tokens, indices, pad_token_id, device):
+    '''
+        Embedding one side of a pair batch. Texts which appear more than once are only run through the model once.
+        Returns the embeddings in the order of the given indices and the features that were passed to the model.
+    '''
+    unique_indices = list(dict.fromkeys(indices))
+    features = collate([tokens[index] for index in unique_indices], pad_token_id, device)
+    embeddings = model_body(features)["sentence_embedding"]
+    positions = {index: position for position, index in enumerate(unique_indices)}
+    return embeddings[torch.tensor([positions[index] for index in indices], device=device)], features
+
+
+def encode_tokenized(model_body, tokens, batch_size, normalize=False):
+    '''
+        Computing sentence embeddings from already tokenized texts, batched in length order.
+        Returns a numpy array in the same order as the given tokens.
+    '''
+    device = model_body.device
+    pad_token_id = model_body.tokenizer.pad_token_id
+    order = sorted(range(len(tokens)), key=lambda index: len(tokens[index]))
+    embeddings = [None] * len(tokens)
+
+    model_body.eval()
+    with torch.no_grad():
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start + batch_size]
+            features = collate([tokens[index] for index in batch], pad_token_id, device)
+            batch_embeddings = model_body(features)["sentence_embedding"]
+            if normalize:
+                batch_embeddings = torch.nn.functional.normalize(batch_embeddings, p=2, dim=1)
+            for index, embedding in zip(batch, batch_embeddings.cpu().numpy()):
+                embeddings[index] = embedding
+
+    return np.stack(embeddings)
+
+def embedding_loss(model_body, tokens, pairs, batches):
+    '''
+        Computing the mean cosine similarity loss on pairs without training, like the SetFit Trainer evaluation.
+    '''
+    device = model_body.device
+    pad_token_id = model_body.tokenizer.pad_token_id
+    loss_function = torch.nn.MSELoss(reduction="sum")
+    total_loss = 0.0
+
+    model_body.eval()
+    with torch.no_grad():
+        for batch in batches:
+            batch_pairs = [pairs[index] for index in batch]
+            embeddings_a, _ = embed_side(model_body, tokens, [index_a for index_a, _, _ in batch_pairs], pad_token_id, device)
+            embeddings_b, _ = embed_side(model_body, tokens, [index_b for _, index_b, _ in batch_pairs], pad_token_id, device)
+            targets = torch.tensor([label for _, _, label in batch_pairs], dtype=torch.float, device=device)
+            total_loss += loss_function(torch.cosine_similarity(embeddings_a, embeddings_b), targets).item()
+
+    return total_loss / len(pairs)
+
+def prepare_pairs(model, model_name, df, batch_size, max_pairs_per_division, batches_per_chunk, cache_dir, num_epochs, seed):
+    '''
+        Deduplicating and tokenizing a DataFrame and sampling the length sorted pair batches for every epoch.
+        Returns the DataFrame, the token ids and a list of (pairs, batches) per epoch.
+    '''
+    df = filter_known_divisions(model, deduplicate_descriptions(df))
+    model_body = model.model_body
+    tokens = tokenize_descriptions(df["tender_description"].tolist(), model_body.tokenizer, model_name, model_body.max_seq_length, cache_dir)
+    lengths = [len(ids) for ids in tokens]
+    labels = df["division"].astype(int).tolist()
+
+    epochs = []
+    for epoch in range(num_epochs):
+        pairs = order_pairs(sample_pairs(labels, max_pairs_per_division, seed=seed + epoch), lengths)
+        epochs.append((pairs, length_sorted_batches(pair_sort_keys(pairs, lengths), batch_size, batches_per_chunk, seed=seed + epoch)))
+    return df, tokens, epochs
+
+def train_pretokenized(model, model_name, train_df, val_df, batch_size=16, num_epochs=1, learning_rate=2e-5,
+                       max_pairs_per_division=MAX_PAIRS_PER_DIVISION, batches_per_chunk=BATCHES_PER_CHUNK,
+                       cache_dir=CACHE_DIR, output_dir=CHECKPOINT_DIR, callbacks=None, seed=42):
+    '''
+        Training a SetFitModel on pre-tokenized, length sorted data.
+        The sentence transformer body is fine-tuned with a cosine similarity loss on the sampled pairs
+        with a linear warmup / decay schedule, like the SetFit Trainer.
+        After every epoch the embedding loss on validation pairs is computed and the callbacks get on_evaluate.
+        Only the checkpoint of the best epoch is kept on disk and its body weights are loaded at the end,
+        afterwards the classification head is fitted once on the embeddings of the unique training texts.
+        Throughput, batches, padding, evaluation time and wall time are printed for every epoch.
+    '''
+    train_df, tokens, epochs = prepare_pairs(model, model_name, train_df, batch_size, max_pairs_per_division,
+                                             batches_per_chunk, cache_dir, num_epochs, seed)
+    label_ids = get_label_ids(model, train_df["division"].tolist())
+    _, val_tokens, val_epochs = prepare_pairs(model, model_name, val_df, batch_size, max_pairs_per_division,
+                                              batches_per_chunk, cache_dir, 1, seed)
+    val_pairs, val_batches = val_epochs[0]
+    if not val_pairs:
+        print("No validation pairs could be sampled. The weights of the last epoch are kept.")
+
+    model_body = model.model_body
+    pad_token_id = model_body.tokenizer.pad_token_id
+    device = model_body.device
+    max_steps = sum(len(batches) for _, batches in epochs)
+
+    optimizer = torch.optim.AdamW(model_body.parameters(), lr=learning_rate)
+    scheduler = get_linear_schedule_with_warmup(optimizer, int(WARMUP_PROPORTION * max_steps), max_steps)
+    loss_function = torch.nn.MSELoss()
+
+    state = TrainerState(max_steps=max_steps, num_train_epochs=num_epochs)
+    best_loss = None
+    best_epoch = None
+    best_body_state = None
+    best_checkpoint = None
+
+    training_start = time.time()
+    for epoch, (pairs, batches) in enumerate(epochs):
+        model_body.train()
+        epoch_start = time.time()
+        epoch_loss = 0.0
+        real_tokens = padded_tokens = 0
+        for batch in batches:
+            batch_pairs = [pairs[index] for index in batch]
+            embeddings_a, features_a = embed_side(model_body, tokens, [index_a for index_a, _, _ in batch_pairs], pad_token_id, device)
+            embeddings_b, features_b = embed_side(model_body, tokens, [index_b for _, index_b, _ in batch_pairs], pad_token_id, device)
+            targets = torch.tensor([label for _, _, label in batch_pairs], dtype=torch.float, device=device)
+
+            loss = loss_function(torch.cosine_similarity(embeddings_a, embeddings_b), targets)
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            scheduler.step()
+            epoch_loss += loss.item()
+            state.global_step += 1
+
+            for features in (features_a, features_b):
+                real_tokens += int(features["attention_mask"].sum())
+                padded_tokens += features["attention_mask"].numel()
+
+        epoch_time = time.time() - epoch_start
+        state.epoch = epoch + 1
+        print(f"Epoch {epoch + 1}/{num_epochs}: loss {epoch_loss / max(len(batches), 1):.4f}, "
+              f"{len(pairs)} pairs in {len(batches)} batches (mean batch size {len(pairs) / max(len(batches), 1):.1f}), "
+              f"{epoch_time:.2f} seconds ({len(pairs) / max(epoch_time, 1e-9):.1f} pairs/s), "
+              f"padding {1 - real_tokens / max(padded_tokens, 1):.1%} of {padded_tokens} tokens")
+
+        eval_start = time.time()
+        val_loss = embedding_loss(model_body, val_tokens, val_pairs, val_batches) if val_pairs else None
+        for callback in callbacks or []:
+            callback.on_evaluate(None, state, None, model=model)
+        print(f"Epoch {epoch + 1}/{num_epochs}: validation embedding loss {val_loss}, evaluation took {time.time() - eval_start:.2f} seconds")
+
+        if val_loss is None or best_loss is None or val_loss < best_loss:
+            best_loss = val_loss
+            best_epoch = epoch
+            checkpoint = os.path.join(output_dir, f"step_{state.global_step}")
+            model.save_pretrained(checkpoint)
+            if best_checkpoint is not None:
+                shutil.rmtree(best_checkpoint, ignore_errors=True)
+            best_checkpoint = checkpoint
+            if val_loss is not None and epoch < num_epochs - 1:
+                best_body_state = copy.deepcopy(model_body.state_dict())
+
+    if best_epoch is not None and best_epoch < num_epochs - 1:
+        print(f"Loading the body weights of epoch {best_epoch + 1} (validation embedding loss {best_loss:.4f})")
+        model_body.load_state_dict(best_body_state)
+
+    head_start = time.time()
+    embeddings = encode_tokenized(model_body, tokens, batch_size, normalize=model.normalize_embeddings)
+    model.model_head.fit(embeddings, label_ids)
+    print(f"Fitted classification head in {time.time() - head_start:.2f} seconds")
+
+    print(f"Total training wall time: {time.time() - training_start:.2f} seconds")
+
+    return model
+
+def evaluate_pretokenized(model, model_name, test_df, batch_size=16, cache_dir=CACHE_DIR):
+    '''
+        Evaluating the accuracy of a model trained with train_pretokenized on every row of a DataFrame,
+        so the result is comparable with the SetFit Trainer evaluation.
+        Rows with a missing or unknown division count as wrong predictions.
+        Every unique text is only tokenized and encoded once.
+    '''
+    if test_df.shape[0] == 0:
+        raise ValueError("The test DataFrame must not be empty.")
+
+    model_body = model.model_body
+    tokens = tokenize_descriptions(test_df["tender_description"].tolist(), model_body.tokenizer, model_name, model_body.max_seq_length, cache_dir)
+    unique_tokens = {tuple(ids): position for position, ids in enumerate(dict.fromkeys(tuple(ids) for ids in tokens))}
+    embeddings = encode_tokenized(model_body, [list(ids) for ids in unique_tokens], batch_size, normalize=model.normalize_embeddings)
+    preds = model.model_head.predict(embeddings)
+
+    label_ids = [get_label_id_or_none(model, division) for division in test_df["division"].tolist()]
+    correct = sum(bool(preds[unique_tokens[tuple(ids)]] == label_id) for ids, label_id in zip(tokens, label_ids))
+
+    return {"accuracy": correct / len(label_ids)}
@@ -0,0 +1,49 @@
+import pytest
+
+import setfit_batching
+
+
+@pytest.mark.parametrize("division_sizes", [[3] * 40, [1000, 5], [2, 1000, 3], [2, 1, 7]])
+def test_sample_pairs_is_balanced_capped_and_unique(division_sizes):
+    labels = [division for division, size in enumerate(division_sizes) for _ in range(size)]
+    max_pairs = 200
+    pairs = setfit_batching.sample_pairs(labels, max_pairs)
+
+    positive = [(a, b) for a, b, label in pairs if label == 1.0]
+    negative = [(a, b) for a, b, label in pairs if label == 0.0]
+    assert len(positive) == len(negative)
+    assert len(set(positive)) == len(positive)
+    assert all(labels[a] == labels[b] and a != b for a, b in positive)
+    assert all(labels[a] != labels[b] for a, b in negative)
+
+    for division, size in enumerate(division_sizes):
+        expected = min(max_pairs // 2, size * (size - 1) // 2)
+        assert sum(labels[a] == division for a, _ in positive) == expected
+        assert sum(labels[a] == division for a, _ in negative) == expected
+
+
+def test_sample_pairs_single_division_has_no_pairs():
+    assert setfit_batching.sample_pairs([0, 0, 0]) == []
+
+
+def test_length_sorted_batches_covers_every_index_once_with_full_batches():
+    sort_keys = [(index * 7) % 100 for index in range(600)]
+    batches = setfit_batching.length_sorted_batches(sort_keys, batch_size=16, batches_per_chunk=5)
+
+    flat = [index for batch in batches for index in batch]
+    assert sorted(flat) == list(range(600))
+    assert len(batches) == 38
+    assert sum(len(batch) < 16 for batch in batches) == 1
+
+
+def test_length_sorted_batches_sorts_inside_a_chunk():
+    sort_keys = list(range(64))
+    batches = setfit_batching.length_sorted_batches(sort_keys, batch_size=8, batches_per_chunk=8)
+    assert all(max(batch) - min(batch) == 7 for batch in batches)
+
+
+def test_order_pairs_puts_shorter_text_on_side_a():
+    lengths = [10, 300, 12, 290]
+    pairs = setfit_batching.order_pairs([(0, 1, 1.0), (3, 2, 0.0)], lengths)
+    assert pairs == [(0, 1, 1.0), (2, 3, 0.0)]
+    assert setfit_batching.pair_sort_keys(pairs, lengths) == [(300, 10), (290, 12)]
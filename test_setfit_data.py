@@ -0,0 +1,60 @@
+import pytest
+
+pd = pytest.importorskip("pandas")
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+import setfit_data
+
+
+def test_deduplicate_descriptions_drops_empty_non_string_and_duplicates():
+    df = pd.DataFrame({
+        "tender_description": ["a", " a ", " ", None, 42, "b", "c"],
+        "division": [1, 2, 3, 4, 5, None, 6],
+    })
+    result = setfit_data.deduplicate_descriptions(df)
+    assert result["tender_description"].tolist() == ["a", "c"]
+    assert result["division"].tolist() == [1, 6]
+
+
+def test_collate_pads_and_masks():
+    features = setfit_data.collate([[5, 6, 7], [8]], pad_token_id=1, device="cpu")
+    assert features["input_ids"].tolist() == [[5, 6, 7], [8, 1, 1]]
+    assert features["attention_mask"].tolist() == [[1, 1, 1], [1, 0, 0]]
+
+
+class FakeTokenizer:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, texts, truncation, max_length):
+        self.calls += 1
+        return {"input_ids": [[len(text)] * min(len(text), max_length) for text in texts]}
+
+
+def test_tokenize_descriptions_caches_and_appends(tmp_path):
+    tokenizer = FakeTokenizer()
+    first = setfit_data.tokenize_descriptions(["ab", "cde"], tokenizer, "model", 8, str(tmp_path))
+    second = setfit_data.tokenize_descriptions(["cde", "f", "ab"], tokenizer, "model", 8, str(tmp_path))
+    third = setfit_data.tokenize_descriptions(["f", "ab"], tokenizer, "model", 8, str(tmp_path))
+
+    assert first == [[2, 2], [3, 3, 3]]
+    assert second == [[3, 3, 3], [1], [2, 2]]
+    assert third == [[1], [2, 2]]
+    assert tokenizer.calls == 2
+
+
+def test_tokenize_descriptions_strips_texts(tmp_path):
+    tokenizer = FakeTokenizer()
+    tokens = setfit_data.tokenize_descriptions(["ab", "  ab\n"], tokenizer, "model", 8, str(tmp_path))
+    assert tokens == [[2, 2], [2, 2]]
+    assert tokenizer.calls == 1
+
+
+def test_tokenize_descriptions_recovers_from_broken_index(tmp_path):
+    tokenizer = FakeTokenizer()
+    setfit_data.tokenize_descriptions(["ab"], tokenizer, "model", 8, str(tmp_path))
+    _, index_path = setfit_data.get_cache_paths(str(tmp_path), "model", 8)
+    with open(index_path, 'w') as file:
+        file.write('{"trunc')
+
+    assert setfit_data.tokenize_descriptions(["ab", "c"], tokenizer, "model", 8, str(tmp_path)) == [[2, 2], [1]]
@@ -11,9 +11,12 @@ from setfit import SetFitModel, Trainer, TrainingArguments
 from sklearn.model_selection import train_test_split
 from datasets import Dataset
 from transformers.trainer_callback import TrainerCallback, TrainerState, TrainerControl
+import setfit_data
 
 # use case:
 # python3 train_setfit.py -i ../new_data -c ../cpv_exel/cpv_2008_ver_2013.xlsx -s ../formatting_pipeline --load --test
+# pre-tokenized, length sorted training on CPU:
+# python3 train_setfit.py -i ../new_data -c ../cpv_exel/cpv_2008_ver_2013.xlsx -s ../formatting_pipeline --load --pretokenize --max-pairs 200
 
 class EmbeddingPlotCallback(TrainerCallback):
     """Simple embedding plotting callback that plots the tSNE of the training and evaluation datasets throughout training."""
@@ -91,6 +94,10 @@ def main():
     parser.add_argument("-s", "--scripts", type=str, help="The path for the new_dataframe and formatting scripts")
     parser.add_argument("-l", "--load", action="store_true", help="Set to True to load the already formatted json dataset.", default=False)
     parser.add_argument("-t", "--test", action="store_true", help="Set to True to use a smaler dataset for test purpouses only.", default=False)
+    parser.add_argument("-p", "--pretokenize", action="store_true", help="Set to True to train on deduplicated, pre-tokenized and length sorted data.", default=False)
+    parser.add_argument("--cache-dir", type=str, help="The directory for the tokenizer cache", default=setfit_data.CACHE_DIR)
+    parser.add_argument("--max-pairs", type=int, help="The maximum number of sampled pairs per division", default=setfit_data.MAX_PAIRS_PER_DIVISION)
+    parser.add_argument("--chunk-batches", type=int, help="The number of batches which are sorted by length together", default=setfit_data.BATCHES_PER_CHUNK)
 
     args = parser.parse_args()
 
@@ -102,6 +109,10 @@ def main():
         raise ValueError("The 'scripts' parameter must be given.")
     if not isinstance(args.test, bool):
         raise ValueError("The 'test' parameter must be a boolean value.")
+    if args.max_pairs < 2:
+        raise ValueError("The 'max-pairs' parameter must be at least 2.")
+    if args.chunk_batches < 1:
+        raise ValueError("The 'chunk-batches' parameter must be at least 1.")
     
     formatting, new_dataframes, read_json = import_scripts(args.scripts)
 
@@ -152,31 +163,50 @@ def main():
     # setfit model
     labels = cpv_numbers["division"].tolist()
     #labels = [code[:-2] for code in labels]
+    model_name = "sentence-transformers/paraphrase-mpnet-base-v2"
     model = SetFitModel.from_pretrained(
-        "sentence-transformers/paraphrase-mpnet-base-v2",
+        model_name,
         labels=labels,
     )
 
-    setfit_args = TrainingArguments(
-        batch_size=16,
-        num_epochs=10,
-        evaluation_strategy="epoch",
-        save_strategy="epoch",
-        load_best_model_at_end=True,
-    )
+    batch_size = 16
+    num_epochs = 10
     embedding_plot_callback = EmbeddingPlotCallback(train_dataset=train_dataset, eval_dataset=val_dataset)
 
-    trainer = Trainer(
-        model=model,
-        args=setfit_args,
-        train_dataset=train_dataset,
-        eval_dataset=val_dataset,
-        callbacks=[embedding_plot_callback],
-        column_mapping={"tender_description": "text", "division": "label"}  # Map dataset columns to text/label expected by trainer
-    )
-
-    trainer.train()
-    metrics = trainer.evaluate(test_dataset)
+    if args.pretokenize:
+        setfit_data.train_pretokenized(
+            model,
+            model_name,
+            train_df,
+            val_df,
+            batch_size=batch_size,
+            num_epochs=num_epochs,
+            max_pairs_per_division=args.max_pairs,
+            batches_per_chunk=args.chunk_batches,
+            cache_dir=args.cache_dir,
+            callbacks=[embedding_plot_callback],
+        )
+        metrics = setfit_data.evaluate_pretokenized(model, model_name, test_df, batch_size=batch_size, cache_dir=args.cache_dir)
+    else:
+        setfit_args = TrainingArguments(
+            batch_size=batch_size,
+            num_epochs=num_epochs,
+            evaluation_strategy="epoch",
+            save_strategy="epoch",
+            load_best_model_at_end=True,
+        )
+
+        trainer = Trainer(
+            model=model,
+            args=setfit_args,
+            train_dataset=train_dataset,
+            eval_dataset=val_dataset,
+            callbacks=[embedding_plot_callback],
+            column_mapping={"tender_description": "text", "division": "label"}  # Map dataset columns to text/label expected by trainer
+        )
+
+        trainer.train()
+        metrics = trainer.evaluate(test_dataset)
     print(metrics)
 
     for index, row in test_df.iterrows():